@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Ahead-of-time compile the skibot physics kernel.
+
+Running this script produces a skibot_physics extension module next to
+skibot_node.py.  When that module is present the node imports the
+compiled kernel directly, avoiding Numba's JIT warmup (and the
+llvmlite dependency) at every node start.  Without it the node falls
+back to JIT-compiling, or to plain Python, so building is optional.
+
+Usage:
+    python build_physics_aot.py
+
+Author: Nathan Sprague
+
+"""
+
+import os
+
+from numba.pycc import CC
+
+import skibot_physics_kernel
+
+_SIGNATURE = 'UniTuple(f8, 6)(' + ', '.join(['f8'] * 15) + ')'
+
+
+def main():
+    cc = CC('skibot_physics')
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.verbose = True
+    cc.export('step', _SIGNATURE)(skibot_physics_kernel.step)
+    cc.compile()
+
+
+if __name__ == "__main__":
+    main()
@@ -30,12 +30,28 @@ Author: Nathan Sprague
 #http://www.gpwiki.org/index.php/Python:Pygame_basics
 
 
+import functools
+import math
+import threading
 import time
 import pygame
-import numpy as np
 import rospy
 import roslib.packages
 
+try:
+    # Prefer the ahead-of-time compiled kernel (see
+    # build_physics_aot.py); it carries no JIT warmup cost at startup.
+    from skibot_physics import step as _physics_step
+except ImportError:
+    from skibot_physics_kernel import step as _physics_step
+    try:
+        from numba import njit
+        _physics_step = njit(cache=True, fastmath=True)(_physics_step)
+    except ImportError:
+        # Numba is optional.  Without it the kernel runs as ordinary
+        # (slower) Python.
+        pass
+
 from pygame.locals import *
 import pygame.transform
 import pygame.image
@@ -55,11 +71,50 @@ SCREEN_HEIGHT_PX = 480
 SCREEN_WIDTH_M = float(SCREEN_WIDTH_PX) / PIXELS_PER_METER
 SCREEN_HEIGHT_M = float(SCREEN_HEIGHT_PX) / PIXELS_PER_METER
 
+# Shared do-nothing wrench, so expiring a thrust doesn't allocate.
+_ZERO_WRENCH = Wrench()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_scaled_image(package, folder, name, width, height):
+    """Load an image from a ROS package resource and scale it.
+
+    resource_file walks the ROS package index on every call and the
+    decode + rescale aren't cheap either, so results are cached in
+    case the same image is requested again.
+
+    """
+    img_file = roslib.packages.resource_file(package, folder, name)
+    image = pygame.image.load(img_file)
+    image = pygame.transform.smoothscale(image, (width, height))
+    return image.convert_alpha()
+
+
+def _build_rotation_cache(image):
+    """Pre-render an image at each whole degree of rotation.
+
+    rotozoom re-samples the full surface on every call, so rotating on
+    the fly is far too expensive to do once per frame.  Returns
+    (surfaces, half_widths, half_heights) lists indexed by degree.  The
+    rotated surfaces vary slightly in size with the angle, so the half
+    extents are cached alongside to avoid per-frame get_rect() calls.
+
+    """
+    surfaces = []
+    half_widths = []
+    half_heights = []
+    for angle in range(360):
+        surf = pygame.transform.rotozoom(image, angle, 1.0).convert_alpha()
+        surfaces.append(surf)
+        half_widths.append(surf.get_width() // 2)
+        half_heights.append(surf.get_height() // 2)
+    return surfaces, half_widths, half_heights
 
-def pos_to_pixels(pos):
+
+def pos_to_pixels(x, y):
     """ Convert from meters to screen position. """
-    return (int(pos[0] * PIXELS_PER_METER),
-            SCREEN_HEIGHT_PX - int(pos[1] * PIXELS_PER_METER))
+    return (int(x * PIXELS_PER_METER),
+            SCREEN_HEIGHT_PX - int(y * PIXELS_PER_METER))
 
 class Skibot(object):
     """ Sliding robot. """
@@ -80,102 +135,65 @@ class Skibot(object):
         self._screen = screen
         self.set_pose(pos, theta)
         self.set_vel_zero()
-        img_file = roslib.packages.resource_file('skibot', 'images',
-                                                 'indigo.png')
-        self.image = pygame.image.load(img_file)
-        height_px = 48
-        width_px = 48
-
-        self.image = pygame.transform.smoothscale(self.image, (width_px,
-                                                               height_px))
-        self.image.convert()
+        self.bind_dt(.01)
+        self.image = _load_scaled_image('skibot', 'images', 'indigo.png',
+                                        48, 48)
+        (self._rot_cache, self._rot_half_w,
+         self._rot_half_h) = _build_rotation_cache(self.image)
 
     def set_pose(self, pos, theta):
         """ Set pose """
-        self.pos = np.array(pos, dtype='float64')
+        self.x = float(pos[0])
+        self.y = float(pos[1])
         self.theta = theta
+        self.dirty = True
 
     def set_vel_zero(self):
         """ Set all velocities to zero. """
-        self.vel = np.array([0, 0], dtype='float64')
+        self.vx = 0.0
+        self.vy = 0.0
         self.vel_rot = 0.0
 
-    def update(self, wrench, dt):
-        """Update the position and velocity based on the thrust.  Redraw the
-        robot at the new position.
+    def bind_dt(self, dt):
+        """Fix the simulation time step and precompute the physics
+        constants that depend on it, so that update does no redundant
+        arithmetic per tick.
+
+        """
+        self._dt = dt
+        self._ang_acc_dt = dt / self.MOMENT_OF_INERTIA
+        self._ang_fric_dt = self.TORQUE_FRICTION / self.MOMENT_OF_INERTIA * dt
+        self._inv_mass_dt = dt / self.MASS
+        self._lin_fric_dt = self.LINEAR_FRICTION / self.MASS * dt
+        self._xmax = float(self._screen.get_width()) / PIXELS_PER_METER
+        self._ymax = float(self._screen.get_height()) / PIXELS_PER_METER
+
+    def update(self, wrench):
+        """ Update the position and velocity based on the thrust. """
+        torque = min(max(wrench.torque.z, -self.MAX_TORQUE), self.MAX_TORQUE)
+        force = min(max(wrench.force.x, -self.MAX_FORCE), self.MAX_FORCE)
+
+        (self.x, self.y, self.theta,
+         self.vx, self.vy, self.vel_rot) = _physics_step(
+             force, torque, self.x, self.y,
+             self.theta, self.vx, self.vy, self.vel_rot,
+             self._dt, self._ang_acc_dt, self._ang_fric_dt,
+             self._inv_mass_dt, self._lin_fric_dt, self._xmax, self._ymax)
+
+        # Flag a redraw if anything actually happened this tick.
+        if (force != 0 or torque != 0 or
+                abs(self.vx) + abs(self.vy) + abs(self.vel_rot) > 1e-6):
+            self.dirty = True
+
+    def draw(self):
+        """Draw the robot at its current position.  Returns the screen
+        rectangle that was drawn to.
 
         """
-        #https://physics.stackexchange.com/questions/349451/
-        #expression-for-angular-friction
-
-        # Angular Component
-        # First, calculate angular velocity in the absense of friction
-
-        torque = np.clip(wrench.torque.z, -self.MAX_TORQUE, self.MAX_TORQUE)
-        angular_acc = torque / self.MOMENT_OF_INERTIA
-        no_fric_vel = self.vel_rot + angular_acc * dt
-
-        # Friction acts in the opposite direction...
-        angular_acc_fric = (-np.sign(no_fric_vel) * self.TORQUE_FRICTION /
-                            self.MOMENT_OF_INERTIA)
-        angular_vel_fric = no_fric_vel + angular_acc_fric * dt
-
-        # Friction can't turn something backwards...
-        if np.sign(angular_vel_fric) != np.sign(no_fric_vel):
-            angular_vel_fric = 0
-
-        self.vel_rot = angular_vel_fric
-
-        # Linear component
-
-        # FIRST, calculate velocity in the absense of friction
-        force = np.clip(wrench.force.x, -self.MAX_FORCE, self.MAX_FORCE)
-        linear_acc = (force / self.MASS)
-        x_acc = np.sin(self.theta + np.pi/2) * linear_acc
-        y_acc = np.cos(self.theta + np.pi/2) * linear_acc
-        acc = np.array([x_acc, y_acc], dtype='float32')
-        no_fric_vel = self.vel + acc * dt
-
-        # Friction acts in the opposite direction...
-        if np.linalg.norm(no_fric_vel) > 0:
-            force_friction = (-(no_fric_vel/np.linalg.norm(no_fric_vel)) *
-                              self.LINEAR_FRICTION)
-        else:
-            force_friction = np.zeros(2)
-
-        accel_fric = force_friction / self.MASS
-        fric_vel = no_fric_vel + accel_fric * dt
-
-        # Friction can't push something backwards...
-        fric_vel[np.sign(fric_vel) != np.sign(no_fric_vel)] = 0
-        self.vel = fric_vel
-
-        # Finally... Update the pose.
-        self.pos += self.vel * dt
-        self.theta += self.vel_rot * dt
-
-        # Handle bouncing.
-        if self.pos[0] > float(self._screen.get_width()) / PIXELS_PER_METER:
-            self.pos[0] = float(self._screen.get_width()) / PIXELS_PER_METER
-            self.vel[0] = -self.vel[0]
-        if self.pos[0] < 0:
-            self.pos[0] = 0
-            self.vel[0] = -self.vel[0]
-        if self.pos[1] > float(self._screen.get_height()) / PIXELS_PER_METER:
-            self.pos[1] = float(self._screen.get_height()) / PIXELS_PER_METER
-            self.vel[1] = -self.vel[1]
-        if self.pos[1] < 0:
-            self.pos[1] = 0
-            self.vel[1] = -self.vel[1]
-
-        # Draw the robot.
-        surf = pygame.transform.rotozoom(self.image,
-                                         np.rad2deg(self.theta), 1.0)
-        pixel_x = (self.pos[0]*PIXELS_PER_METER-surf.get_rect().width
-                   * .5)
-        pixel_y = (self.pos[1]*PIXELS_PER_METER-surf.get_rect().height
-                   * .5)
-        self._screen.blit(surf, (pixel_x, pixel_y))
+        idx = int(math.degrees(self.theta)) % 360
+        pixel_x = int(self.x * PIXELS_PER_METER) - self._rot_half_w[idx]
+        pixel_y = int(self.y * PIXELS_PER_METER) - self._rot_half_h[idx]
+        return self._screen.blit(self._rot_cache[idx], (pixel_x, pixel_y))
 
 
 class SkibotNode(object):
@@ -188,8 +206,12 @@ class SkibotNode(object):
         rospy.Subscriber('target_point', Point, self.target_point_callback)
         self.target_pose = None
         self.target_point = None
+        self._draw_target = self._draw_no_target
         self.loc_pub = rospy.Publisher('pose', Pose, queue_size=10)
         self.pub_rate = 35.0
+        # Reused for every publish; the serializer copies the fields
+        # out, so mutating one message between publishes is safe.
+        self._pose_msg = Pose()
         rospy.Service('teleport', Teleport,
                       self.handle_teleport_service)
 
@@ -199,36 +221,66 @@ class SkibotNode(object):
         self.screen = pygame.display.set_mode((SCREEN_WIDTH_PX,
                                                SCREEN_HEIGHT_PX))
         self.refresh_rate = 100
+        self.render_rate = 60.0
+        self._needs_render = True
         pygame.display.set_caption('Skibot 354')
         self.rocket = Skibot(self.screen, (SCREEN_WIDTH_M/2,
                                            SCREEN_HEIGHT_M/2), 0.0)
+        self.rocket.bind_dt(1.0 / self.refresh_rate)
         
         # load and prep arrow image.
-        arrow_file = roslib.packages.resource_file('skibot', 'images',
-                                                   'arrow.png')
-        self.arrow_img = pygame.image.load(arrow_file)
-        self.arrow_img = pygame.transform.smoothscale(self.arrow_img,
-                                                      (38, 8))
+        self.arrow_img = _load_scaled_image('skibot', 'images', 'arrow.png',
+                                            38, 8)
         square = pygame.Surface((38, 38), flags=SRCALPHA)
         square.fill((255, 255, 255, 0))
         square.blit(self.arrow_img, (0, 15))
         self.arrow_img = square
-        self.arrow_img.convert()
+        (self._arrow_cache, self._arrow_half_w,
+         self._arrow_half_h) = _build_rotation_cache(self.arrow_img)
 
-        self.cur_wrench = Wrench()
+        self.cur_wrench = _ZERO_WRENCH
+        self._thrust_active = False
         self.thrust_start = 0
 
+        # Publish the pose from a timer thread so the main loop
+        # doesn't need to poll the clock every tick.  The lock keeps
+        # the published state consistent with the physics updates.
+        self._state_lock = threading.Lock()
+        rospy.Timer(rospy.Duration(1.0 / self.pub_rate), self._publish_pose)
+
     def wrench_callback(self, wrench):
         self.thrust_start = time.time()
         self.cur_wrench = wrench
+        self._thrust_active = True
 
     def target_pose_callback(self, pose_msg):
         self.target_pose = pose_msg
         self.target_point = None
+        self._draw_target = self._draw_pose_target
+        self._needs_render = True
 
     def target_point_callback(self, point_msg):
         self.target_point = point_msg
         self.target_pose = None
+        self._draw_target = self._draw_point_target
+        self._needs_render = True
+
+    def _draw_no_target(self):
+        """ No target marker to draw. """
+        return None
+
+    def _draw_pose_target(self):
+        """ Draw the target pose arrow.  Returns the drawn rect. """
+        pixel_pos = pos_to_pixels(self.target_pose.x, self.target_pose.y)
+        idx = int(math.degrees(self.target_pose.theta)) % 360
+        return self.screen.blit(self._arrow_cache[idx],
+                                (pixel_pos[0] - self._arrow_half_w[idx],
+                                 pixel_pos[1] - self._arrow_half_h[idx]))
+
+    def _draw_point_target(self):
+        """ Draw the target point marker.  Returns the drawn rect. """
+        pixel_pos = pos_to_pixels(self.target_point.x, self.target_point.y)
+        return pygame.draw.circle(self.screen, (0, 255, 0), pixel_pos, 5)
 
     def handle_teleport_service(self, teleport_srv):
         """ Move the skibot to the goal location. """
@@ -245,55 +297,76 @@ class SkibotNode(object):
         self.wrench = Wrench()
         return TeleportResponse(True)
 
+    def _publish_pose(self, event):
+        """ Publish the current pose.  Runs on a rospy.Timer thread. """
+        pose = self._pose_msg
+        with self._state_lock:
+            pose.x = self.rocket.x
+            pose.y = SCREEN_HEIGHT_M - self.rocket.y
+            # Wrap to (-pi, pi] with a single libm call.
+            pose.theta = math.remainder(self.rocket.theta, math.tau)
+            pose.x_velocity = self.rocket.vx
+            pose.y_velocity = self.rocket.vy
+            pose.theta_velocity = self.rocket.vel_rot
+        self.loc_pub.publish(pose)
+
 
     def run(self):
-        last_pub = 0.0
         rate = rospy.Rate(self.refresh_rate)
+        render_accum = 0.0
         done = False
+
+        # Paint the background once; after this only the rectangles
+        # that actually change are repainted and pushed to the display.
+        self.screen.fill((255, 255, 255))
+        pygame.display.flip()
+        prev_rects = []
+        drain_ticks = 0
         while not rospy.is_shutdown() and not done:
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    done = True
+            # Only the QUIT event matters; peek checks for it without
+            # building a list of event objects every tick.
+            if pygame.event.peek(pygame.QUIT):
+                done = True
+
+            # Drain the ignored events about once per second so the
+            # SDL queue can't grow without bound.
+            drain_ticks += 1
+            if drain_ticks >= self.refresh_rate:
+                drain_ticks = 0
+                pygame.event.clear()
 
             rate.sleep()
-            self.screen.fill((255, 255, 255))
 
-            if ((self.cur_wrench.force.x != 0 or
-                 self.cur_wrench.torque.z != 0) and
-                time.time() > self.thrust_start + .6):
+            if (self._thrust_active and
+                    time.time() > self.thrust_start + .6):
                 # Stop obeying last wrench after .6 seconds.
-                self.cur_wrench = Wrench()
-
-            self.rocket.update(self.cur_wrench, 1.0/self.refresh_rate)
-
-            if self.target_pose is not None:
-                pixel_pos = pos_to_pixels((self.target_pose.x,
-                                           self.target_pose.y))
-                angle = np.rad2deg(self.target_pose.theta)
-                surf = pygame.transform.rotozoom(self.arrow_img,
-                                                 angle, 1.0)
-                self.screen.blit(surf, (pixel_pos[0] -
-                                        surf.get_rect().width * .5,
-                                        (pixel_pos[1] -
-                                         surf.get_rect().height * .5)))
-            elif self.target_point is not None:
-                pixel_pos = pos_to_pixels((self.target_point.x,
-                                           self.target_point.y))
-                pygame.draw.circle(self.screen, (0, 255, 0), pixel_pos, 5)
-
-            pygame.display.flip()
-
-            if (time.time() > (last_pub + 1.0/self.pub_rate -
-                               1/self.refresh_rate)):
-                angle = (self.rocket.theta + np.pi) % (2 * np.pi) - np.pi
-
-                pose = Pose(self.rocket.pos[0], float(SCREEN_HEIGHT_PX) /
-                            PIXELS_PER_METER - self.rocket.pos[1], angle,
-                            self.rocket.vel[0], self.rocket.vel[1],
-                            self.rocket.vel_rot)
-                self.loc_pub.publish(pose)
-                last_pub = time.time()
+                self.cur_wrench = _ZERO_WRENCH
+                self._thrust_active = False
+
+            with self._state_lock:
+                self.rocket.update(self.cur_wrench)
+            if self.rocket.dirty:
+                self.rocket.dirty = False
+                self._needs_render = True
+
+            # Physics runs at the full refresh rate, but redrawing is
+            # capped at render_rate and skipped entirely while nothing
+            # on screen has changed.
+            render_accum += 1.0 / self.refresh_rate
+            if render_accum >= 1.0 / self.render_rate and self._needs_render:
+                render_accum = 0.0
+                self._needs_render = False
+                for rect in prev_rects:
+                    self.screen.fill((255, 255, 255), rect)
+                new_rects = [self.rocket.draw()]
+
+                target_rect = self._draw_target()
+                if target_rect is not None:
+                    new_rects.append(target_rect)
+
+                pygame.display.update(prev_rects + new_rects)
+                prev_rects = new_rects
 
 if __name__ == "__main__":
     node = SkibotNode()
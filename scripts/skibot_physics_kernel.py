@@ -0,0 +1,109 @@
+"""Scalar physics kernel for the skibot simulation.
+
+This module is deliberately free of ROS and pygame imports so that it
+can be compiled ahead of time by build_physics_aot.py (or JIT-compiled
+by Numba) without pulling in the rest of the node's dependencies.
+
+Author: Nathan Sprague
+
+"""
+
+import math
+
+
+def step(force, torque, x, y, theta, vx, vy, vel_rot,
+         dt, ang_acc_dt, ang_fric_dt, inv_mass_dt, lin_fric_dt,
+         xmax, ymax):
+    """Advance the robot state by a single time step.
+
+    This operates entirely on scalars so that Numba can compile it
+    without any ndarray boxing at the call boundary.  The *_dt
+    arguments are constants pre-multiplied by the time step (see
+    Skibot.bind_dt).  Returns the updated (x, y, theta, vx, vy,
+    vel_rot).
+
+    """
+    #https://physics.stackexchange.com/questions/349451/
+    #expression-for-angular-friction
+
+    if force == 0 and torque == 0:
+        # Coasting fast path: with no thrust, friction just decays
+        # the velocity straight toward zero, so the sign-reversal
+        # checks below are unnecessary.
+        abs_rot = abs(vel_rot) - ang_fric_dt
+        vel_rot = math.copysign(abs_rot, vel_rot) if abs_rot > 0 else 0.0
+
+        speed = math.hypot(vx, vy)
+        if speed > lin_fric_dt:
+            fric_scale = 1.0 - lin_fric_dt / speed
+            vx *= fric_scale
+            vy *= fric_scale
+        else:
+            vx = 0.0
+            vy = 0.0
+    else:
+        # Angular Component
+        # First, calculate angular velocity in the absense of friction
+
+        no_fric_rot = vel_rot + torque * ang_acc_dt
+
+        if no_fric_rot != 0:
+            # Friction acts in the opposite direction...
+            angular_vel_fric = no_fric_rot - math.copysign(ang_fric_dt,
+                                                           no_fric_rot)
+
+            # Friction can't turn something backwards...
+            if angular_vel_fric * no_fric_rot < 0:
+                angular_vel_fric = 0.0
+        else:
+            angular_vel_fric = 0.0
+
+        vel_rot = angular_vel_fric
+
+        # Linear component
+
+        # FIRST, calculate velocity in the absense of friction.  The
+        # thrust direction is (sin(theta + pi/2), cos(theta + pi/2)),
+        # which is just (cos(theta), -sin(theta)).
+        acc_dt = force * inv_mass_dt
+        no_fric_vx = vx + math.cos(theta) * acc_dt
+        no_fric_vy = vy - math.sin(theta) * acc_dt
+
+        if no_fric_vx == 0 and no_fric_vy == 0:
+            # At rest with no net thrust this tick; there is nothing
+            # for friction to act on.
+            fric_vx = 0.0
+            fric_vy = 0.0
+        else:
+            # Friction acts in the opposite direction...
+            speed = math.hypot(no_fric_vx, no_fric_vy)
+            fric_scale = 1.0 - lin_fric_dt / speed
+            fric_vx = no_fric_vx * fric_scale
+            fric_vy = no_fric_vy * fric_scale
+
+            # Friction can't push something backwards...
+            if fric_vx * no_fric_vx < 0:
+                fric_vx = 0.0
+            if fric_vy * no_fric_vy < 0:
+                fric_vy = 0.0
+
+        vx = fric_vx
+        vy = fric_vy
+
+    # Finally... Update the pose.
+    x += vx * dt
+    y += vy * dt
+    theta += vel_rot * dt
+
+    # Handle bouncing: clamp to the screen and flip the velocity on
+    # the axis that hit a wall.
+    clamped = 0.0 if x < 0 else (xmax if x > xmax else x)
+    if clamped != x:
+        x = clamped
+        vx = -vx
+    clamped = 0.0 if y < 0 else (ymax if y > ymax else y)
+    if clamped != y:
+        y = clamped
+        vy = -vy
+
+    return x, y, theta, vx, vy, vel_rot